@@ -5,23 +5,66 @@ Solves 30 browser challenges using Gemini Flash + Playwright
 """
 
 import asyncio
-import base64
+import contextvars
+import datetime
+import io
 import json
 import os
+import re
 import sys
 import time
+from collections import deque
 from dataclasses import dataclass, field
 from pathlib import Path
 
 from playwright.async_api import async_playwright, Page
 import google.generativeai as genai
+from typing_extensions import TypedDict  # pydantic (SDK schema builder) rejects typing.TypedDict before 3.12
+
+from routing import filter_request
+
+try:
+    from PIL import Image  # Optional: downscales screenshots before upload
+except ImportError:
+    Image = None
+
+try:
+    # Optional: libjpeg-turbo's SIMD codec for the downscale's decode/encode
+    import numpy as np
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):  # Library missing or older than libjpeg-turbo 3.0
+    turbo_jpeg = None
 
 # ============ CONFIG ============
 CHALLENGE_URL = "https://serene-frangipane-7fd25b.netlify.app/"
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-3-flash-preview")  # Gemini 3 Flash Preview - best for agentic
 MAX_RETRIES_PER_CHALLENGE = 3
+MAX_WAIT_MS = 1000  # Longest single "wait" action
+MAX_WAIT_PER_CHALLENGE_MS = 3000
+MAX_CONSECUTIVE_WAITS = 2  # After this many in a row, click a button instead of asking Gemini again
+# Give up on a challenge early when Gemini repeats itself unsure, or when the
+# moving average of its confidence stays low for several attempts in a row
+REPEAT_CONFIDENCE_FLOOR = 0.3
+AVG_CONFIDENCE_FLOOR = 0.25
+CONFIDENCE_WINDOW = 3
+# Set to e.g. "https://.../#/challenge/{n}" when challenges can be opened
+# directly; only then are they spread over MAX_PARALLEL_PAGES browser contexts.
+CHALLENGE_URL_TEMPLATE = os.getenv("CHALLENGE_URL_TEMPLATE", "")
+MAX_PARALLEL_PAGES = int(os.getenv("MAX_PARALLEL_PAGES", "4"))
+VIEWPORT = {"width": 1280, "height": 720}
+# Reuse a Chromium profile (HTTP cache, cookies) across runs, e.g. ".pw-profile"
+PW_PROFILE_DIR = os.getenv("PW_PROFILE_DIR", "")
+# 896x504 fits Gemini's 768px vision tiles in 2 tiles instead of 4
+SCREENSHOT_SIZE = (896, 504)
+JPEG_QUALITY = 70
+CAPTURE_QUALITY = 95  # Near-lossless capture when we re-encode after downscaling
+# Explicit context cache for SYSTEM_PROMPT (implicit prefix caching is always on)
+USE_EXPLICIT_CACHE = os.getenv("GEMINI_EXPLICIT_CACHE") == "1"
+SAVE_SCREENSHOTS = os.getenv("SAVE_SCREENSHOTS", "1") != "0"
 SCREENSHOT_DIR = Path("screenshots")
-SCREENSHOT_DIR.mkdir(exist_ok=True)
+if SAVE_SCREENSHOTS:
+    SCREENSHOT_DIR.mkdir(exist_ok=True)
 
 @dataclass
 class Stats:
@@ -31,10 +74,11 @@ class Stats:
     total_tokens: int = 0
     input_tokens: int = 0
     output_tokens: int = 0
+    cached_tokens: int = 0
     challenges_solved: int = 0
     challenges_failed: int = 0
     actions_taken: int = 0
-    errors: list = field(default_factory=list)
+    errors: deque = field(default_factory=lambda: deque(maxlen=10))  # Last 10 errors
     
     @property
     def duration_seconds(self) -> float:
@@ -43,9 +87,10 @@ class Stats:
     @property
     def cost_estimate(self) -> float:
         # Gemini 3 Flash Preview pricing (as of Feb 2026)
-        # Input: $0.50 / 1M tokens, Output: $3.00 / 1M tokens
+        # Input: $0.50 / 1M tokens, Cached input: $0.05 / 1M, Output: $3.00 / 1M tokens
         # Source: https://cloud.google.com/vertex-ai/generative-ai/pricing
-        input_cost = (self.input_tokens / 1_000_000) * 0.50
+        uncached_tokens = self.input_tokens - self.cached_tokens
+        input_cost = (uncached_tokens / 1_000_000) * 0.50 + (self.cached_tokens / 1_000_000) * 0.05
         output_cost = (self.output_tokens / 1_000_000) * 3.00
         return input_cost + output_cost
     
@@ -55,23 +100,73 @@ class Stats:
             "total_tokens": self.total_tokens,
             "input_tokens": self.input_tokens,
             "output_tokens": self.output_tokens,
+            "cached_tokens": self.cached_tokens,
             "cost_estimate_usd": round(self.cost_estimate, 4),
             "challenges_solved": self.challenges_solved,
             "challenges_failed": self.challenges_failed,
             "actions_taken": self.actions_taken,
-            "errors": self.errors[-10:],  # Last 10 errors
+            "errors": list(self.errors),
         }
+    
+    def merge(self, other: "Stats"):
+        """Add another Stats' counters and errors to this one"""
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.cached_tokens += other.cached_tokens
+        self.total_tokens = self.input_tokens + self.output_tokens
+        self.challenges_solved += other.challenges_solved
+        self.challenges_failed += other.challenges_failed
+        self.actions_taken += other.actions_taken
+        self.errors.extend(other.errors)
 
-stats = Stats()
+# Whole-run totals; each worker counts into its own Stats (via stats_ctx)
+# so interleaved challenges never share counters, merged in at the end.
+run_stats = Stats()
+stats_ctx: contextvars.ContextVar[Stats] = contextvars.ContextVar("stats")
 
 # ============ GEMINI SETUP ============
 def setup_gemini():
     api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
     if not api_key:
         raise ValueError("Set GEMINI_API_KEY or GOOGLE_API_KEY environment variable")
+    # No transport override: the SDK default gives the async client its
+    # grpc_asyncio channel, which generate_content_async needs. That one
+    # long-lived HTTP/2 channel is shared by all workers through this model.
     genai.configure(api_key=api_key)
+    
+    if USE_EXPLICIT_CACHE:
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=GEMINI_MODEL,
+                contents=[SYSTEM_PROMPT],
+                ttl=datetime.timedelta(seconds=300),
+            )
+            return genai.GenerativeModel.from_cached_content(cached_content=cache)
+        except Exception as e:
+            run_stats.errors.append(f"Cache error: {str(e)}")
     return genai.GenerativeModel(GEMINI_MODEL)
 
+def delete_prompt_cache(model):
+    """Delete the explicit SYSTEM_PROMPT cache behind model, if it has one"""
+    cache_name = getattr(model, "cached_content", None)
+    if not cache_name:
+        return
+    try:
+        genai.caching.CachedContent.get(cache_name).delete()
+    except Exception as e:
+        run_stats.errors.append(f"Cache error: {str(e)}")
+
+class Action(TypedDict):
+    """Response schema Gemini's JSON mode is held to"""
+    thinking: str
+    action: str
+    target: str
+    value: str
+    confidence: float
+    previous_succeeded: bool
+
+GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": Action}
+
 SYSTEM_PROMPT = """You are a browser automation agent. Analyze screenshots and determine the next action to solve UI challenges.
 
 RESPONSE FORMAT (JSON only):
@@ -80,9 +175,14 @@ RESPONSE FORMAT (JSON only):
   "action": "click|type|select|scroll|press|wait|done",
   "target": "CSS selector or description",
   "value": "text to type or key to press (if applicable)",
-  "confidence": 0.0-1.0
+  "confidence": 0.0-1.0,
+  "previous_succeeded": true|false
 }
 
+When given BEFORE and AFTER screenshots, set "previous_succeeded" to true only if
+the AFTER screenshot shows the previous action completed the challenge. Otherwise
+set it to false. Either way, also give the next action for the AFTER screenshot.
+
 ACTIONS:
 - click: Click an element. target = CSS selector like "button.submit" or "#login"
 - type: Type text into focused element or specified input. target = selector, value = text
@@ -97,52 +197,173 @@ TIPS:
 - Read any instructions on screen
 - If stuck, try clicking the most prominent interactive element
 - Watch for success messages or visual changes indicating completion
+
+EXAMPLES:
+Screen shows a single "Start" button in the middle of the page:
+{"thinking": "Only one control is visible, a Start button", "action": "click", "target": "button:has-text('Start')", "value": "", "confidence": 0.95, "previous_succeeded": false}
+
+Screen shows "Enter the code shown above" with the code 4821 and an empty text box:
+{"thinking": "The code is 4821 and the input is empty", "action": "type", "target": "input[type='text']", "value": "4821", "confidence": 0.9, "previous_succeeded": false}
+
+Screen shows the typed code in the input and a Submit button next to it:
+{"thinking": "Code is entered, now submit it", "action": "click", "target": "button[type='submit']", "value": "", "confidence": 0.9, "previous_succeeded": false}
+
+Screen shows a "Choose your country" dropdown and the instruction "Select Canada":
+{"thinking": "Need to pick Canada from the select element", "action": "select", "target": "select", "value": "Canada", "confidence": 0.85, "previous_succeeded": false}
+
+Screen shows "Scroll down to find the hidden button" and no button in view:
+{"thinking": "The button is below the fold", "action": "scroll", "target": "down", "value": "", "confidence": 0.8, "previous_succeeded": false}
+
+Screen shows a search box that already contains the requested text "playwright":
+{"thinking": "Text is in place, submitting with Enter", "action": "press", "target": "", "value": "Enter", "confidence": 0.85, "previous_succeeded": false}
+
+Screen shows a spinner with the text "Loading challenge...":
+{"thinking": "The page is still loading", "action": "wait", "value": "1000", "target": "", "confidence": 0.7, "previous_succeeded": false}
+
+Screen shows three checkboxes and the instruction "Check only the second box":
+{"thinking": "Second checkbox must be checked", "action": "click", "target": "input[type='checkbox'] >> nth=1", "value": "", "confidence": 0.85, "previous_succeeded": false}
+
+Screen shows a modal dialog that covers the page with a close (X) button in its corner:
+{"thinking": "A modal blocks the challenge, close it first", "action": "click", "target": "[aria-label='Close']", "value": "", "confidence": 0.8, "previous_succeeded": false}
+
+Screen shows "Press Escape to dismiss the overlay":
+{"thinking": "Instruction asks for the Escape key", "action": "press", "target": "", "value": "Escape", "confidence": 0.9, "previous_succeeded": false}
+
+Screen shows a login form with "Username: admin" and "Password: hunter2" printed as hints:
+{"thinking": "Fill the username field first using the hint", "action": "type", "target": "input[name='username']", "value": "admin", "confidence": 0.85, "previous_succeeded": false}
+
+Screen shows a link reading "Continue to the next level" at the bottom of the page:
+{"thinking": "The continue link advances the challenge", "action": "click", "target": "a:has-text('Continue')", "value": "", "confidence": 0.9, "previous_succeeded": false}
+
+Screen shows a green banner "Challenge complete!" and nothing else to interact with:
+{"thinking": "Success message is visible, the challenge is solved", "action": "done", "target": "", "value": "", "confidence": 0.95, "previous_succeeded": false}
+
+Screen shows "What is 9 + 9?" and a red error "Wrong answer, try again" under an input containing 17:
+{"thinking": "17 was rejected, the correct sum is 18", "action": "type", "target": "input", "value": "18", "confidence": 0.85, "previous_succeeded": false}
+
+Screen shows a slider labelled "Set volume to 100" with a Max button next to it:
+{"thinking": "The Max button sets the slider to 100", "action": "click", "target": "button:has-text('Max')", "value": "", "confidence": 0.8, "previous_succeeded": false}
 """
 
-async def analyze_screenshot(model, screenshot_bytes: bytes, challenge_num: int) -> dict:
-    """Send screenshot to Gemini and get action"""
-    global stats
+async def analyze_screenshot(model, screenshot_bytes: bytes, challenge_num: int, before: bytes | None = None) -> dict:
+    """Send screenshot to Gemini and get action. With before, ask for a verdict too"""
+    stats = stats_ctx.get()
     
-    # Save screenshot for debugging
-    screenshot_path = SCREENSHOT_DIR / f"challenge_{challenge_num}_{int(time.time())}.png"
-    screenshot_path.write_bytes(screenshot_bytes)
+    # Save screenshot for debugging, off the event loop and without waiting
+    if SAVE_SCREENSHOTS:
+        screenshot_path = SCREENSHOT_DIR / f"challenge_{challenge_num}_{int(time.time())}.jpg"
+        write = asyncio.get_running_loop().run_in_executor(None, screenshot_path.write_bytes, screenshot_bytes)
+        write.add_done_callback(lambda f: record_write_error(stats, f))
     
-    # Create image part
-    image_part = {
-        "mime_type": "image/png",
-        "data": base64.b64encode(screenshot_bytes).decode()
-    }
+    # Create image parts (the SDK takes raw bytes, no base64 needed)
+    image_part = {"mime_type": "image/jpeg", "data": screenshot_bytes}
     
-    prompt = f"Challenge #{challenge_num}. What action should I take? Respond with JSON only."
+    if before is None:
+        images = [image_part]
+        prompt = f"Challenge #{challenge_num}. What action should I take? Respond with JSON only."
+    else:
+        before_part = {"mime_type": "image/jpeg", "data": before}
+        images = ["BEFORE:", before_part, "AFTER:", image_part]
+        prompt = (
+            f"Challenge #{challenge_num}. The page changed after the previous action. "
+            "Did the previous action succeed? If yes, give the NEXT action; if no, retry. "
+            "Respond with JSON only."
+        )
     
     try:
-        response = model.generate_content(
-            [SYSTEM_PROMPT, image_part, prompt],
-            generation_config={"response_mime_type": "application/json"}
+        response = await model.generate_content_async(
+            # SYSTEM_PROMPT stays the first, byte-identical part so Gemini can
+            # cache it as a prefix, unless it already sits in an explicit cache.
+            [*images, prompt] if getattr(model, "cached_content", None) else [SYSTEM_PROMPT, *images, prompt],
+            generation_config=GENERATION_CONFIG,
+            stream=True,
         )
         
-        # Track tokens
-        if hasattr(response, 'usage_metadata'):
-            stats.input_tokens += getattr(response.usage_metadata, 'prompt_token_count', 0)
-            stats.output_tokens += getattr(response.usage_metadata, 'candidates_token_count', 0)
-            stats.total_tokens = stats.input_tokens + stats.output_tokens
+        # Streaming keeps the event loop free while the response arrives
+        text = ""
+        async for chunk in response:
+            try:
+                text += chunk.text
+            except ValueError:
+                continue  # Chunk without text parts (e.g. usage only)
         
-        # Parse response
-        text = response.text.strip()
-        if text.startswith("```"):
-            text = text.split("```")[1]
-            if text.startswith("json"):
-                text = text[4:]
-        
-        return json.loads(text)
+        record_usage(response)
+        action = parse_action(text)
+        if action is None:
+            raise ValueError(f"No JSON object in response: {text[:200]!r}")
+        return action
     except Exception as e:
         stats.errors.append(f"Gemini error: {str(e)}")
         return {"action": "wait", "value": "500", "thinking": f"Error: {e}"}
 
+def record_write_error(stats: Stats, write: asyncio.Future):
+    """Done-callback for a background screenshot write: keep its error"""
+    if not write.cancelled() and write.exception() is not None:
+        stats.errors.append(f"Screenshot save error: {str(write.exception())}")
+
+_json_decoder = json.JSONDecoder()
+
+def parse_action(text: str) -> dict | None:
+    """Decode the first JSON object in text, None if there is none"""
+    start = text.find("{")
+    if start < 0:
+        return None
+    try:
+        action, _ = _json_decoder.raw_decode(text, start)
+    except json.JSONDecodeError:
+        return None
+    return action
+
+def record_usage(response):
+    """Add a response's token usage to the stats"""
+    stats = stats_ctx.get()
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    stats.input_tokens += getattr(usage, 'prompt_token_count', 0)
+    stats.output_tokens += getattr(usage, 'candidates_token_count', 0)
+    stats.cached_tokens += getattr(usage, 'cached_content_token_count', 0)
+    stats.total_tokens = stats.input_tokens + stats.output_tokens
+
 # ============ BROWSER ACTIONS ============
-async def execute_action(page: Page, action: dict, verbose: bool = False) -> bool:
-    """Execute the action from Gemini"""
-    global stats
+def wait_ms(action: dict) -> int:
+    """Duration of a wait action in ms, capped at MAX_WAIT_MS"""
+    try:
+        return max(0, min(int(action.get("value") or 500), MAX_WAIT_MS))
+    except (TypeError, ValueError):
+        return 500
+
+async def capture_screenshot(page: Page) -> bytes:
+    """Screenshot the viewport as a JPEG, downscaled when Pillow is available"""
+    shot = await page.screenshot(
+        type="jpeg",
+        # Only one lossy JPEG_QUALITY pass on what Gemini sees
+        quality=JPEG_QUALITY if Image is None else CAPTURE_QUALITY,
+        clip={"x": 0, "y": 0, **VIEWPORT},
+        full_page=False,
+    )
+    if Image is None:
+        return shot
+    # CPU-bound, so keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, downscale_jpeg, shot)
+
+def downscale_jpeg(shot: bytes) -> bytes:
+    """Shrink a JPEG to fit SCREENSHOT_SIZE and re-encode it"""
+    if turbo_jpeg is not None:
+        img = Image.fromarray(turbo_jpeg.decode(shot, pixel_format=TJPF_RGB))
+    else:
+        img = Image.open(io.BytesIO(shot))
+    img.thumbnail(SCREENSHOT_SIZE, Image.BILINEAR)
+    
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(np.asarray(img), quality=JPEG_QUALITY, pixel_format=TJPF_RGB)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=JPEG_QUALITY)
+    return out.getvalue()
+
+async def execute_action(page: Page, action: dict, verbose: bool = False, prev: dict | None = None) -> tuple[bool, dict | None]:
+    """Execute the action from Gemini. Returns (is_done, page signature if already taken)"""
+    stats = stats_ctx.get()
     stats.actions_taken += 1
     
     action_type = action.get("action", "wait")
@@ -154,6 +375,19 @@ async def execute_action(page: Page, action: dict, verbose: bool = False) -> boo
     
     try:
         if action_type == "click":
+            if target and prev is not None:
+                # Click, settle and sign the page in one round trip when the
+                # element is plainly clickable; otherwise let Playwright wait.
+                try:
+                    current = await page.evaluate(CLICK_AND_SIGN_JS, [target, prev["rev"]])
+                except Exception as e:
+                    # Possibly a navigation triggered by the click, so don't
+                    # click again; the signature check will see where we are
+                    stats.errors.append(f"Fused click error: {str(e)}")
+                    return False, None
+                if current is not None and (current["rev"] is None or current["rev"] != prev["rev"]):
+                    return False, fill_signature(current, prev)
+                # Untrusted click left the DOM untouched: retry it for real
             if target:
                 await page.click(target, timeout=3000)
             else:
@@ -183,90 +417,324 @@ async def execute_action(page: Page, action: dict, verbose: bool = False) -> boo
             await page.keyboard.press(value)
             
         elif action_type == "wait":
-            await asyncio.sleep(int(value or 500) / 1000)
+            await asyncio.sleep(wait_ms(action) / 1000)
             
         elif action_type == "done":
-            return True  # Signal challenge complete
+            return True, None  # Signal challenge complete
             
         # Small delay after action
         await asyncio.sleep(0.2)
-        return False
+        return False, None
         
     except Exception as e:
         stats.errors.append(f"Action error ({action_type}): {str(e)}")
         if verbose:
             print(f"  ⚠ Action failed: {e}")
         await asyncio.sleep(0.3)
-        return False
+        return False, None
+
+# Installed in every document: window.__rev counts DOM mutation batches, so
+# an unchanged page can be recognised without touching its text. It starts
+# at the document's timeOrigin so a reloaded page never repeats a value.
+REV_COUNTER_JS = """
+window.__rev = performance.timeOrigin;
+new MutationObserver(() => window.__rev++).observe(document, {
+    subtree: true, childList: true, characterData: true, attributes: true,
+});
+"""
+
+# Page URL plus a 64-bit hash of the visible text in a single evaluate, so
+# the body text itself never crosses the wire. Two 32-bit lanes (FNV-1a and
+# djb2-xor) keep it on Math.imul instead of BigInt arithmetic. If __rev is
+# unchanged since prevRev the hash is skipped and returned as null.
+PAGE_SIGNATURE_JS = """(prevRev) => {
+    const rev = window.__rev;
+    if (rev !== undefined && rev === prevRev) {
+        return {url: location.href, rev: rev, hash: null, length: null};
+    }
+    const t = document.body ? document.body.innerText : "";
+    let h1 = 0x811c9dc5, h2 = 5381;
+    for (let i = 0; i < t.length; i++) {
+        const c = t.charCodeAt(i);
+        h1 = Math.imul(h1 ^ c, 16777619);
+        h2 = Math.imul(h2, 33) ^ c;
+    }
+    return {
+        url: location.href,
+        rev: rev === undefined ? null : rev,
+        hash: (h1 >>> 0).toString(16) + ":" + (h2 >>> 0).toString(16),
+        length: t.length,
+    };
+}"""
+
+# Fused click for execute_action: returns null (nothing clicked) when the
+# selector isn't plain CSS or the element is hidden, disabled or covered, so
+# Playwright's actionability checks take over. Otherwise clicks, waits the
+# usual 200ms settle and returns the page signature.
+CLICK_AND_SIGN_JS = """async ([sel, prevRev]) => {
+    let e;
+    try { e = document.querySelector(sel); } catch (err) { return null; }
+    if (!e || e.disabled || !e.getClientRects().length) return null;
+    const r = e.getBoundingClientRect();
+    const hit = document.elementFromPoint(r.left + r.width / 2, r.top + r.height / 2);
+    if (!hit || !(hit === e || e.contains(hit))) return null;
+    e.click();
+    await new Promise(resolve => setTimeout(resolve, 200));
+    return (""" + PAGE_SIGNATURE_JS + """)(prevRev);
+}"""
+
+# Words on a freshly changed page that suggest a new challenge was reached
+CHALLENGE_MARKERS = re.compile(r"challenge|level|task|complete|success|next", re.IGNORECASE)
 
-async def detect_challenge_change(page: Page, prev_url: str, prev_content: str) -> bool:
+async def page_signature(page: Page, prev: dict) -> dict | None:
+    """URL and text hash of the page, None if the page can't be read"""
+    try:
+        current = await page.evaluate(PAGE_SIGNATURE_JS, prev["rev"])
+    except:
+        return None
+    return fill_signature(current, prev)
+
+def fill_signature(current: dict, prev: dict) -> dict:
+    """Carry prev's hash over to a signature whose DOM was untouched"""
+    if current["hash"] is None:
+        current["hash"], current["length"] = prev["hash"], prev["length"]
+    return current
+
+async def detect_challenge_change(page: Page, prev: dict, current: dict | None) -> bool:
     """Detect if we moved to a new challenge"""
+    if current is None:
+        return False
     try:
-        current_url = page.url
-        if current_url != prev_url:
+        if current["url"] != prev["url"]:
             return True
         
-        # Check for content changes suggesting new challenge
-        body = await page.query_selector("body")
-        if body:
-            content = await body.inner_text()
-            # Significant content change might indicate new challenge
-            if len(content) > 0 and content != prev_content:
-                # Look for challenge indicators
-                if any(x in content.lower() for x in ["challenge", "level", "task", "complete", "success", "next"]):
-                    return True
+        # Significant content change might indicate new challenge
+        if current["length"] > 0 and current["hash"] != prev["hash"]:
+            # Only now fetch the text to look for challenge indicators
+            content = await page.evaluate("() => document.body.innerText")
+            if CHALLENGE_MARKERS.search(content):
+                return True
         return False
     except:
         return False
 
+# A lone visible "continue"-style button on a page without form fields is
+# clicked directly. With prominent, the largest visible button is picked
+# regardless (used to get unstuck). The button is tagged so the selector is exact.
+LOCAL_ACTION_JS = """(prominent) => {
+    const visible = e => e.offsetParent !== null && !e.disabled;
+    const buttons = [...document.querySelectorAll('button, a, [role=button], input[type=submit], input[type=button]')].filter(visible);
+    let btn;
+    if (prominent) {
+        const area = e => { const r = e.getBoundingClientRect(); return r.width * r.height; };
+        btn = buttons.sort((a, b) => area(b) - area(a))[0];
+        if (!btn) return null;
+    } else {
+        const fields = [...document.querySelectorAll('input:not([type=submit]):not([type=button]), select, textarea')];
+        if (fields.some(visible)) return null;
+        if (buttons.length !== 1) return null;
+        btn = buttons[0];
+    }
+    const text = (btn.innerText || btn.value || "").trim();
+    if (!prominent && !/next|continue|start|submit|done/i.test(text)) return null;
+    document.querySelectorAll("[data-agent-target]").forEach(e => e.removeAttribute("data-agent-target"));
+    btn.setAttribute("data-agent-target", "");
+    return {target: "[data-agent-target]", text: text};
+}"""
+
+async def local_action(page: Page, prominent: bool = False) -> dict | None:
+    """Action for trivial screens that doesn't need Gemini, if there is one"""
+    try:
+        found = await page.evaluate(LOCAL_ACTION_JS, prominent)
+    except:
+        return None
+    if not found:
+        return None
+    what = "most prominent" if prominent else "only"
+    return {
+        "thinking": f"Local: {what} button is '{found['text'][:40]}'",
+        "action": "click",
+        "target": found["target"],
+        "value": "",
+        "confidence": 1.0,
+        "local": True,
+    }
+
+async def fallback_action(page: Page) -> dict:
+    """Something to click instead of waiting again: the most prominent button, else the page center"""
+    return await local_action(page, prominent=True) or {
+        "thinking": "Stuck waiting, clicking page center",
+        "action": "click",
+        "target": "",
+        "local": True,
+    }
+
 # ============ MAIN SOLVER ============
+def confidence_of(action: dict) -> float:
+    """Gemini's confidence in an action, 0.5 if missing or malformed"""
+    try:
+        return float(action.get("confidence", 0.5))
+    except (TypeError, ValueError):
+        return 0.5
+
+async def next_action(page: Page, model, shot_task: asyncio.Task, challenge_num: int,
+                      before: bytes | None = None, allow_local: bool = True) -> dict:
+    """Plan the next action, locally if possible, otherwise with Gemini"""
+    action = await local_action(page) if allow_local else None
+    if action is not None:
+        shot_task.cancel()
+        return action
+    screenshot = await shot_task
+    return await analyze_screenshot(model, screenshot, challenge_num, before)
+
 async def solve_challenge(page: Page, model, challenge_num: int, verbose: bool = False) -> tuple[bool, float]:
     """Solve a single challenge. Returns (success, time_taken)"""
+    stats = stats_ctx.get()
     challenge_start = time.time()
     
-    prev_url = page.url
-    prev_content = ""
+    # Baseline the page as it is now, so the first action is compared with
+    # real content (and can get a before/after verification)
+    unknown = {"url": page.url, "rev": None, "hash": None, "length": 0}
+    prev = await page_signature(page, unknown) or unknown
+    consecutive_waits = 0
+    waited_ms = 0
+    local_enabled = True  # Off for good once a local click changes nothing
+    seen_actions = set()
+    confidences = []
+    low_confidence_streak = 0
     
-    for attempt in range(MAX_RETRIES_PER_CHALLENGE * 5):  # More attempts per challenge
-        # Take screenshot
-        screenshot = await page.screenshot()
-        
-        # Get action from Gemini
-        action = await analyze_screenshot(model, screenshot, challenge_num)
-        if verbose:
-            print(f"  💭 {action.get('thinking', 'No analysis')[:80]}")
-        
-        # Execute action
-        is_done = await execute_action(page, action, verbose)
-        
-        if is_done or action.get("action") == "done":
-            stats.challenges_solved += 1
-            return True, time.time() - challenge_start
-        
-        # Check if challenge changed
-        if await detect_challenge_change(page, prev_url, prev_content):
-            stats.challenges_solved += 1
-            return True, time.time() - challenge_start
-        
-        # Update tracking
-        try:
-            body = await page.query_selector("body")
-            if body:
-                prev_content = await body.inner_text()
-        except:
-            pass
-        prev_url = page.url
-        
-        # Timeout check
-        if time.time() - stats.start_time > 290:  # 4:50 - leave buffer
-            break
+    # The planned action, and whether it also verifies the previous action
+    # (before/after shots)
+    shot_task = asyncio.create_task(capture_screenshot(page))
+    pending = (asyncio.create_task(next_action(page, model, shot_task, challenge_num)), False)
+    
+    try:
+        for attempt in range(MAX_RETRIES_PER_CHALLENGE * 5):  # More attempts per challenge
+            # Get action from Gemini
+            action_task, verifying = pending
+            action = await action_task
+            if verifying and action.get("previous_succeeded") is True:
+                # Page changed and Gemini confirmed the previous action solved it
+                stats.challenges_solved += 1
+                return True, time.time() - challenge_start
+            
+            # Stop burning attempts on a challenge Gemini is stuck on (local
+            # actions say nothing about that, so only Gemini's plans count)
+            if not action.get("local"):
+                key = (action.get("action"), action.get("target"), action.get("value"))
+                confidences.append(confidence_of(action))
+                recent = confidences[-CONFIDENCE_WINDOW:]
+                if sum(recent) / len(recent) < AVG_CONFIDENCE_FLOOR:
+                    low_confidence_streak += 1
+                else:
+                    low_confidence_streak = 0
+                repeated_unsure = (
+                    key in seen_actions
+                    and len(confidences) >= 2
+                    and max(confidences[-2:]) < REPEAT_CONFIDENCE_FLOOR
+                )
+                if repeated_unsure or low_confidence_streak >= CONFIDENCE_WINDOW:
+                    if verbose:
+                        print("  ⏭ Giving up early: Gemini is stuck")
+                    break
+                seen_actions.add(key)
+            
+            # Gemini answers "wait" when it is confused; keep within the budget
+            if action.get("action") == "wait":
+                remaining = MAX_WAIT_PER_CHALLENGE_MS - waited_ms
+                if remaining <= 0:
+                    action = await fallback_action(page)
+                else:
+                    ms = min(wait_ms(action), remaining)
+                    action = {**action, "value": str(ms)}
+                    waited_ms += ms
+            if action.get("action") == "wait":
+                consecutive_waits += 1
+            else:
+                consecutive_waits = 0
+            if verbose:
+                print(f"  💭 {action.get('thinking', 'No analysis')[:80]}")
+            
+            # Execute action
+            is_done, current = await execute_action(page, action, verbose, prev)
+            
+            if is_done or action.get("action") == "done":
+                stats.challenges_solved += 1
+                return True, time.time() - challenge_start
+            
+            # The next screenshot is captured while the page is signed
+            before_task = shot_task
+            shot_task = asyncio.create_task(capture_screenshot(page))
+            if current is None:
+                current = await page_signature(page, prev)
+            
+            # Content changed without looking like a new challenge: let the
+            # next Gemini call compare before/after and judge the last action.
+            before = None
+            if (current is not None and prev["hash"] is not None and current["hash"] != prev["hash"]
+                    and before_task.done() and not before_task.cancelled() and before_task.exception() is None):
+                before = before_task.result()
+            # A local click that left the page as it was means the heuristic
+            # misread this challenge; leave the rest of it to Gemini
+            unchanged = current is None or (current["url"] == prev["url"] and current["hash"] == prev["hash"])
+            if action.get("local") and unchanged:
+                local_enabled = False
+            if consecutive_waits >= MAX_CONSECUTIVE_WAITS:
+                # Gemini keeps stalling; don't pay for another call to find out
+                shot_task.cancel()
+                pending = (asyncio.create_task(fallback_action(page)), False)
+            else:
+                pending = (
+                    asyncio.create_task(next_action(page, model, shot_task, challenge_num, before, local_enabled)),
+                    before is not None,
+                )
+            
+            # The next plan is already in flight while we check whether the
+            # challenge changed; it is dropped (in finally) if so
+            if await detect_challenge_change(page, prev, current):
+                stats.challenges_solved += 1
+                return True, time.time() - challenge_start
+            
+            # Update tracking
+            if current is not None:
+                prev = current
+            
+            # Timeout check
+            if time.time() - run_stats.start_time > 290:  # 4:50 - leave buffer
+                break
+    finally:
+        # Never leave a screenshot or a plan running past this challenge
+        shot_task.cancel()
+        pending[0].cancel()
     
     stats.challenges_failed += 1
     return False, time.time() - challenge_start
 
+async def launch_contexts(p, count: int):
+    """Start Chromium and return (contexts, close) for count workers"""
+    if PW_PROFILE_DIR:
+        # One persistent profile keeps the HTTP cache warm across runs; it
+        # can only back a single context, so workers share it page by page.
+        context = await p.chromium.launch_persistent_context(
+            PW_PROFILE_DIR, headless=True, viewport=VIEWPORT, bypass_csp=True
+        )
+        # No request filtering here: routing disables the HTTP cache, which
+        # is what the persistent profile is for
+        await context.add_init_script(REV_COUNTER_JS)
+        return [context] * count, context.close
+    
+    browser = await p.chromium.launch(headless=True)
+    contexts = [
+        await browser.new_context(viewport=VIEWPORT, bypass_csp=True)
+        for _ in range(count)
+    ]
+    for context in contexts:
+        await context.route("**/*", filter_request)
+        await context.add_init_script(REV_COUNTER_JS)
+    return contexts, browser.close
+
 async def run_agent(verbose: bool = False):
     """Main agent loop"""
-    global stats
     
     print("🤖 Browser Challenge Agent")
     print(f"📍 Target: {CHALLENGE_URL}")
@@ -276,34 +744,51 @@ async def run_agent(verbose: bool = False):
     # Setup Gemini
     model = setup_gemini()
     
-    stats.start_time = time.time()
+    run_stats.start_time = time.time()
     
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        context = await browser.new_context(viewport={"width": 1280, "height": 720})
+    # Challenges are handed out in order to however many pages run at once
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(1, 31):
+        queue.put_nowait(i)
+    
+    async def worker(context):
+        """Solve challenges from the queue on a page of its own"""
+        stats = Stats()
+        stats_ctx.set(stats)
         page = await context.new_page()
         
-        # Navigate to challenge
-        await page.goto(CHALLENGE_URL, wait_until="networkidle")
-        await asyncio.sleep(1)
-        
-        # Solve challenges with live progress
-        total_time = 0.0
+        # Navigate to challenge (sequential mode walks the site from the start)
+        if not CHALLENGE_URL_TEMPLATE:
+            try:
+                await page.goto(CHALLENGE_URL, wait_until="domcontentloaded")
+            except Exception as e:
+                stats.errors.append(f"Navigation error: {str(e)}")
+            await asyncio.sleep(1)
         
-        for i in range(1, 31):
-            if time.time() - stats.start_time > 290:
-                print(f"\n⏰ Time limit approaching, stopping...")
+        while not queue.empty():
+            if time.time() - run_stats.start_time > 290:
                 break
+            i = queue.get_nowait()
             
-            success, challenge_time = await solve_challenge(page, model, i, verbose)
-            total_time += challenge_time
+            # One challenge blowing up must not take the other workers down
+            challenge_start = time.time()
+            try:
+                if CHALLENGE_URL_TEMPLATE:
+                    await page.goto(CHALLENGE_URL_TEMPLATE.format(n=i), wait_until="domcontentloaded")
+                    await asyncio.sleep(1)
+                success, challenge_time = await solve_challenge(page, model, i, verbose)
+            except Exception as e:
+                stats.errors.append(f"Challenge {i} error: {str(e)}")
+                stats.challenges_failed += 1
+                success, challenge_time = False, time.time() - challenge_start
+            elapsed = time.time() - run_stats.start_time
             
             # Print progress line like: [ 1/30] ✓ 1.7s | Total: 1.7s
             status = "✓" if success else "✗"
             color_status = f"\033[92m{status}\033[0m" if success else f"\033[91m{status}\033[0m"
-            print(f"[{i:2d}/30] {color_status} {challenge_time:.1f}s | Total: {total_time:.1f}s")
+            print(f"[{i:2d}/30] {color_status} {challenge_time:.1f}s | Total: {elapsed:.1f}s")
             
-            if not success:
+            if not success and not CHALLENGE_URL_TEMPLATE:
                 # Try to find and click "next" or "skip" button
                 try:
                     next_btn = await page.query_selector("text=Next, text=Skip, text=Continue, button")
@@ -312,21 +797,42 @@ async def run_agent(verbose: bool = False):
                         await asyncio.sleep(0.5)
                 except:
                     pass
-        
-        await browser.close()
+        return stats
     
-    stats.end_time = time.time()
+    # Independent challenges need a URL per challenge; otherwise one page
+    # has to walk through them in order.
+    workers = max(1, MAX_PARALLEL_PAGES) if CHALLENGE_URL_TEMPLATE else 1
+    
+    try:
+        async with async_playwright() as p:
+            contexts, close = await launch_contexts(p, workers)
+            
+            # Solve challenges with live progress
+            worker_stats = await asyncio.gather(*[worker(context) for context in contexts])
+            if not queue.empty():
+                print(f"\n⏰ Time limit approaching, stopped early")
+            
+            await close()
+    finally:
+        # An explicit cache is billed for storage until deleted or expired
+        delete_prompt_cache(model)
+    
+    for stats in worker_stats:
+        run_stats.merge(stats)
+    run_stats.end_time = time.time()
     
     # Print final summary
     print()
-    print(f"🏁 Finished in {stats.duration_seconds:.2f}s")
-    print(f"✅ Solved: {stats.challenges_solved}/30")
-    if stats.challenges_failed > 0:
-        print(f"❌ Failed: {stats.challenges_failed}")
-    print(f"💰 Est. cost: ${stats.cost_estimate:.4f}")
+    print(f"🏁 Finished in {run_stats.duration_seconds:.2f}s")
+    print(f"✅ Solved: {run_stats.challenges_solved}/30")
+    if run_stats.challenges_failed > 0:
+        print(f"❌ Failed: {run_stats.challenges_failed}")
+    print(f"💰 Est. cost: ${run_stats.cost_estimate:.4f}")
+    if verbose:
+        print(f"🗄  Cached input tokens: {run_stats.cached_tokens}/{run_stats.input_tokens}")
     
     # Save results
-    results = stats.to_dict()
+    results = run_stats.to_dict()
     results_path = Path("run_results.json")
     results_path.write_text(json.dumps(results, indent=2))
     
@@ -2,14 +2,29 @@
 """Quick peek at the challenge site"""
 
 import asyncio
+import os
 from playwright.async_api import async_playwright
 
+from routing import filter_request
+
+PW_PROFILE_DIR = os.getenv("PW_PROFILE_DIR", "")
+
 async def peek():
     async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page(viewport={"width": 1280, "height": 720})
+        viewport = {"width": 1280, "height": 720}
+        if PW_PROFILE_DIR:
+            # Warm profile shared with agent.py runs
+            browser = context = await p.chromium.launch_persistent_context(
+                PW_PROFILE_DIR, headless=True, viewport=viewport, bypass_csp=True
+            )
+        else:
+            browser = await p.chromium.launch(headless=True)
+            context = await browser.new_context(viewport=viewport, bypass_csp=True)
+            # Only here: routing disables the HTTP cache the profile keeps warm
+            await context.route("**/*", filter_request)
+        page = await context.new_page()
         
-        await page.goto("https://serene-frangipane-7fd25b.netlify.app/", wait_until="networkidle")
+        await page.goto("https://serene-frangipane-7fd25b.netlify.app/", wait_until="domcontentloaded")
         await asyncio.sleep(2)
         
         # Screenshot
@@ -0,0 +1,15 @@
+"""Request filtering shared by agent.py and peek.py"""
+
+from urllib.parse import urlparse
+
+# Requests that never show up in a screenshot and only delay page loads
+BLOCKED_RESOURCE_TYPES = {"font", "media", "websocket", "other"}
+BLOCKED_HOSTS = ("google-analytics", "googletagmanager", "doubleclick", "hotjar", "segment")
+
+async def filter_request(route):
+    request = route.request
+    host = urlparse(request.url).hostname or ""
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(h in host for h in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()